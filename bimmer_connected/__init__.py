@@ -1,5 +1,12 @@
 """Init file for bimmer_connected."""
 
-import pkg_resources  # part of setuptools
+try:
+    from importlib.metadata import version
+except ImportError:  # Python < 3.8
+    from pkg_resources import get_distribution
 
-__version__ = pkg_resources.get_distribution("bimmer_connected").version
+    def version(distribution_name: str) -> str:
+        """Get the version of an installed distribution."""
+        return get_distribution(distribution_name).version
+
+__version__ = version("bimmer_connected")
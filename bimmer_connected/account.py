@@ -9,11 +9,16 @@ This library is not affiliated with or endorsed by BMW Group.
 """
 
 import datetime
+import email.utils
 import logging
 import pathlib
+import random
+import re
+import time
 import urllib
 import json
-from threading import Lock
+import weakref
+from threading import Lock, Timer, current_thread
 from typing import Callable, List
 import requests
 
@@ -28,10 +33,87 @@ from bimmer_connected.const import AUTH_URL, VEHICLES_URL, ERROR_CODE_MAPPING
 
 _LOGGER = logging.getLogger(__name__)
 
+#: time in seconds to refresh the oauth token before it actually expires, at most half of its lifetime is used
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+#: time in seconds to wait before retrying a failed background token refresh
+_TOKEN_REFRESH_RETRY_DELAY = 60
+
+#: maximum time in seconds to wait before retrying a rate limited request, requests that the server asks to
+#: retry even later are not retried
+_MAX_RETRY_DELAY = 30
+
+#: Retry-After header given as a number of seconds instead of a date
+_RETRY_AFTER_SECONDS_RE = re.compile(r'^\s*(\d+)\s*$')
+
+#: oauth tokens, shared by all accounts with the same credentials
+_SHARED_TOKENS = weakref.WeakValueDictionary()  # type: weakref.WeakValueDictionary
+_SHARED_TOKENS_GUARD = Lock()
+
+
+def _log_unexpected_response(response: requests.Response, expected_response: int) -> str:
+    """Log a response with an unexpected status code and get a message describing the error."""
+    error_description = ERROR_CODE_MAPPING.get(response.status_code, "UNKNOWN_ERROR")
+    msg = ("The BMW Connected Drive portal returned an error: {} (received status code {} and expected {})."
+           .format(error_description, response.status_code, expected_response))
+    _LOGGER.debug(msg)
+    if _LOGGER.isEnabledFor(logging.DEBUG):
+        _LOGGER.debug(response.text)
+    return msg
+
+
+class _OAuthToken:  # pylint: disable=too-few-public-methods
+    """OAuth token for a user, together with the lock for getting a new one."""
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.access_token = None
+        #: expiration of the token in seconds since the epoch
+        self.expiration = None
+        #: time in seconds since the epoch when the token should be refreshed
+        self.refresh_at = None
+
+    def needs_refresh(self) -> bool:
+        """Check if the token is missing or about to expire."""
+        return self.refresh_at is None or time.time() >= self.refresh_at
+
+
+def _get_shared_token(region: Regions, username: str, password: str) -> _OAuthToken:
+    """Get the oauth token for a user.
+
+    Accounts created with the same credentials share the token, so that only one of them requests a new token
+    when it expires. The token is dropped together with the last account using it.
+    """
+    with _SHARED_TOKENS_GUARD:
+        return _SHARED_TOKENS.setdefault((region, username, password), _OAuthToken())
+
+
+def _get_retry_delay(attempt: int, response: requests.Response) -> float:
+    """Get the time in seconds to wait before retrying a rate limited request.
+
+    A delay requested by the server in the Retry-After header is returned as it is, even if it exceeds
+    _MAX_RETRY_DELAY. Otherwise the delay grows exponentially with the number of attempts and is randomized, so
+    that clients do not retry in lockstep.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        match = _RETRY_AFTER_SECONDS_RE.match(retry_after)
+        if match:
+            return int(match.group(1))
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            _LOGGER.debug('Could not parse Retry-After header: %s', retry_after)
+    return min(_MAX_RETRY_DELAY, 2 ** attempt * (1 + random.uniform(0, 0.5)))
+
 
 class ConnectedDriveAccount:  # pylint: disable=too-many-instance-attributes
     """Create a new connection to the BMW Connected Drive web service.
 
+    The connections to the server are kept open and reused between requests. Use the account as a context
+    manager or call close() to release them when the account is not needed anymore.
+
     :param username: Connected drive user name
     :param password: Connected drive password
     :param country: Country for which the account was created. For a list of valid countries,
@@ -44,86 +126,170 @@ class ConnectedDriveAccount:  # pylint: disable=too-many-instance-attributes
                 Connected Drive server will automatically be retried the number of times
                 specified in the event the error code received was 500. This sometimes
                 occurs (presumably) due to bugs in the server implementation.
+    :param retries_on_429_error: If the Connected Drive server rejects a request as too many
+                requests (error code 429), it will be retried up to this number of times. The
+                wait between the retries grows exponentially.
     """
 
     # pylint: disable=too-many-arguments
     def __init__(self, username: str, password: str, region: Regions, log_responses: pathlib.Path = None,
-                 retries_on_500_error: int = 5) -> None:
+                 retries_on_500_error: int = 5, retries_on_429_error: int = 3) -> None:
         self._region = region
         self._server_url = None
+        self._oauth_url = None
         self._username = username
         self._password = password
-        self._oauth_token = None
+        self._oauth_headers = None
+        self._oauth_request_data = None
+        self._token = _get_shared_token(region, username, password)
         self._refresh_token = None
-        self._token_expiration = None
+        self._request_header = None
+        self._request_header_token = None
         self._log_responses = log_responses
+        self._log_file_counters = {}
+        self._session = None
+        self._session_lock = Lock()
         self._retries_on_500_error = retries_on_500_error
+        self._retries_on_429_error = retries_on_429_error
         #: list of vehicles associated with this account.
         self._vehicles = []
-        self._lock = Lock()
+        self._refresh_timer = None
+        self._refresh_timer_lock = Lock()
+        #: timers running a refresh, including those of a refresher that was stopped in the meantime
+        self._running_refreshes = set()
         self._update_listeners = []
 
         self._get_vehicles()
 
     def _get_oauth_token(self) -> None:
         """Get a new auth token from the server."""
-        with self._lock:
-            if self._token_expiration is not None and datetime.datetime.now() < self._token_expiration:
-                _LOGGER.debug('Old token is still valid. Not getting a new one.')
+        # avoid locking while the token is valid, the check is repeated once the lock is acquired
+        if not self._token.needs_refresh():
+            return
+
+        with self._token.lock:
+            # another account of the same user might have refreshed the token while we were waiting
+            if not self._token.needs_refresh():
+                _LOGGER.debug('Token was refreshed in the meantime. Not getting a new one.')
                 return
 
             _LOGGER.debug('getting new oauth token')
-            url = AUTH_URL.format(
-                gcdm_oauth_endpoint=get_gcdm_oauth_endpoint(self._region)
-            )
-
-            headers = {
-                "Content-Type": "application/x-www-form-urlencoded",
-                "Content-Length": "124",
-                "Connection": "Keep-Alive",
-                "Host": urllib.parse.urlparse(url).netloc,
-                "Accept-Encoding": "gzip",
-                "Credentials": "nQv6CqtxJuXWP74xf3CJwUEP:1zDHx6un4cDjybLENN3kyfumX2kEYigWPcQpdvDRpIBk7rOJ",
-                "User-Agent": "okhttp/3.12.2",
-            }
-            headers.update(get_gcdm_oauth_authorization(self._region))
-
-            # we really need all of these parameters
-            values = {
-                'scope': 'authenticate_user vehicle_data remote_services',
-                'grant_type': 'password',
-                'username': self._username,
-                'password': self._password,
-            }
-
-            data = urllib.parse.urlencode(values)
-            expected_response_code = 200
+            url = self.oauth_url
+
+            # the headers only depend on the region, so they are built once
+            if self._oauth_headers is None:
+                self._oauth_headers = {
+                    "Content-Type": "application/x-www-form-urlencoded",
+                    "Host": urllib.parse.urlparse(url).netloc,
+                    "Accept-Encoding": "gzip",
+                    "Credentials": "nQv6CqtxJuXWP74xf3CJwUEP:1zDHx6un4cDjybLENN3kyfumX2kEYigWPcQpdvDRpIBk7rOJ",
+                    "User-Agent": "okhttp/3.12.2",
+                }
+                self._oauth_headers.update(get_gcdm_oauth_authorization(self._region))
+            headers = self._oauth_headers
+
+            if self._oauth_request_data is None:
+                # we really need all of these parameters
+                values = {
+                    'scope': 'authenticate_user vehicle_data remote_services',
+                    'grant_type': 'password',
+                    'username': self._username,
+                    'password': self._password,
+                }
+                self._oauth_request_data = urllib.parse.urlencode(values).encode('ascii')
+            data = self._oauth_request_data
+            msg = 'Authentication failed. Maybe your password is invalid?'
+            # the token is valid from the moment the server issues it, so the time before sending the
+            # request is a safe lower bound for its start of validity
+            requested_at = time.time()
             try:
-                response = self.send_request(url, data=data, headers=headers, allow_redirects=False,
-                                             expected_response=expected_response_code, post=True)
+                # do not wait for a rate limit while holding the lock, all other requests would wait as well
+                response = self._send_with_retries(url, post=True, data=data, headers=headers, allow_redirects=False,
+                                                   retries_on_429_error=0)
             except OSError as exception:
-                msg = 'Authentication failed. Maybe your password is invalid?'
-                _LOGGER.error(msg)
-                _LOGGER.exception(exception)
+                _LOGGER.exception(msg)
                 raise OSError(msg) from exception
 
+            if response.status_code != 200:
+                _log_unexpected_response(response, 200)
+                _LOGGER.error('%s Received status code %d.', msg, response.status_code)
+                raise OSError(msg)
+
             response_json = response.json()
 
-            self._oauth_token = response_json['access_token']
+            token = self._token
+            token.access_token = response_json['access_token']
             expiration_time = int(response_json['expires_in'])
-            self._token_expiration = datetime.datetime.now() + datetime.timedelta(seconds=expiration_time)
-            _LOGGER.debug('got new token %s with expiration date %s', self._oauth_token, self._token_expiration)
+            token.expiration = requested_at + expiration_time
+            # short lived tokens must not be refreshed on every request, set last as it marks the token as valid
+            token.refresh_at = token.expiration - min(TOKEN_REFRESH_MARGIN, expiration_time / 2)
+            _LOGGER.debug('got new token %s with expiration date %s', token.access_token,
+                          datetime.datetime.fromtimestamp(token.expiration))
+
+    def start_background_refresher(self) -> None:
+        """Refresh the oauth token in a background thread shortly before it expires.
+
+        This keeps the token refresh off the path of the requests to the server. If the background refresh
+        fails for some reason, the token is still refreshed when the next request is sent.
+        """
+        with self._refresh_timer_lock:
+            if self._refresh_timer is None or not self._refresh_timer.is_alive():
+                self._schedule_token_refresh()
+
+    def stop_background_refresher(self) -> None:
+        """Stop refreshing the oauth token in the background.
+
+        A refresh that is running already is finished, wait for it with close().
+        """
+        with self._refresh_timer_lock:
+            if self._refresh_timer is not None:
+                self._refresh_timer.cancel()
+                self._refresh_timer = None
+
+    def _schedule_token_refresh(self, delay: float = None) -> None:
+        """Schedule the next background refresh of the oauth token."""
+        if delay is None:
+            delay = max(0.0, self._token.refresh_at - time.time())
+        _LOGGER.debug('scheduling token refresh in %d seconds', delay)
+        self._refresh_timer = Timer(delay, self._refresh_token_in_background)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_token_in_background(self) -> None:
+        """Refresh the oauth token and schedule the next refresh."""
+        with self._refresh_timer_lock:
+            self._running_refreshes.add(current_thread())
+        delay = None
+        try:
+            self._get_oauth_token()
+        except Exception:  # pylint: disable=broad-except
+            # any error would end the timer thread and with it the background refresh for good
+            _LOGGER.exception('Background refresh of the oauth token failed, retrying in %d seconds',
+                              _TOKEN_REFRESH_RETRY_DELAY)
+            delay = _TOKEN_REFRESH_RETRY_DELAY
+        with self._refresh_timer_lock:
+            self._running_refreshes.discard(current_thread())
+            # the refresher might have been stopped or restarted in the meantime
+            if self._refresh_timer is current_thread():
+                self._schedule_token_refresh(delay)
 
     @property
     def request_header(self):
-        """Generate a header for HTTP requests to the server."""
+        """Generate a header for HTTP requests to the server.
+
+        The header is only rebuilt when there is a new oauth token. A copy is returned, so that callers can
+        modify it.
+        """
         self._get_oauth_token()
-        headers = {
-            "accept": "application/json",
-            "Authorization": "Bearer {}".format(self._oauth_token),
-            "referer": "https://www.bmw-connecteddrive.de/app/index.html",
-        }
-        return headers
+        token = self._token.access_token
+        if self._request_header is None or self._request_header_token != token:
+            self._request_header = {
+                "accept": "application/json",
+                "Authorization": "Bearer {}".format(token),
+                "referer": "https://www.bmw-connecteddrive.de/app/index.html",
+            }
+            self._request_header_token = token
+        return dict(self._request_header)
 
     def send_request(self, url: str, data=None, headers=None, expected_response=200, post=False, allow_redirects=True,
                      logfilename: str = None, params: dict = None):
@@ -135,46 +301,96 @@ class ConnectedDriveAccount:  # pylint: disable=too-many-instance-attributes
         if headers is None:
             headers = self.request_header
 
-        for i in range(self._retries_on_500_error + 1):
-            if post:
-                response = requests.post(url, headers=headers, data=data, allow_redirects=allow_redirects,
-                                         params=params)
-            else:
-                response = requests.get(url, headers=headers, data=data, allow_redirects=allow_redirects,
-                                        params=params)
-
-            if response.status_code != expected_response:
-                if response.status_code == 500:
-                    _LOGGER.debug("Error 500 on attempt %d", i+1)
-                    continue
-
-                error_description = ERROR_CODE_MAPPING.get(response.status_code, "UNKNOWN_ERROR")
-                msg = ("The BMW Connected Drive portal returned an error: {} (received status code {} and expected {})."
-                       .format(error_description, response.status_code, expected_response))
-                _LOGGER.debug(msg)
-                _LOGGER.debug(response.text)
-                raise IOError(msg)
-            break
+        response = self._send_with_retries(url, post, headers=headers, data=data,
+                                           allow_redirects=allow_redirects, params=params)
+
+        # error 500 is only left once all retries failed, the response is then passed on to the caller
+        if response.status_code not in (expected_response, 500):
+            raise IOError(_log_unexpected_response(response, expected_response))
 
         self._log_response_to_file(response, logfilename)
         return response
 
+    def _send_with_retries(self, url: str, post: bool, retries_on_429_error: int = None,
+                           **kwargs) -> requests.Response:
+        """Send an http request, retrying if the server answers with error 500 or 429.
+
+        The retries for each error are counted over the whole call, so waiting for rate limits adds up to at
+        most retries_on_429_error times _MAX_RETRY_DELAY. The response is returned whatever its status code is,
+        checking it is up to the caller.
+        """
+        if retries_on_429_error is None:
+            retries_on_429_error = self._retries_on_429_error
+        session = self._get_session()
+        method = session.post if post else session.get
+        retries_500 = 0
+        retries_429 = 0
+        while True:
+            response = method(url, **kwargs)
+            if response.status_code == 500 and retries_500 < self._retries_on_500_error:
+                retries_500 += 1
+                _LOGGER.debug("Error 500 on attempt %d", retries_500)
+                continue
+            if response.status_code == 429 and retries_429 < retries_on_429_error:
+                delay = _get_retry_delay(retries_429, response)
+                retries_429 += 1
+                if delay > _MAX_RETRY_DELAY:
+                    _LOGGER.debug('Error 429 on attempt %d, server asks to retry in %.1f seconds, giving up',
+                                  retries_429, delay)
+                    return response
+                _LOGGER.debug('Error 429 on attempt %d, retrying in %.1f seconds', retries_429, delay)
+                time.sleep(delay)
+                continue
+            return response
+
+    def _get_session(self) -> requests.Session:
+        """Get the http session used for all requests to the server."""
+        session = self._session
+        if session is not None:
+            return session
+        with self._session_lock:
+            if self._session is None:
+                self._session = requests.Session()
+            return self._session
+
+    def close(self) -> None:
+        """Stop the background refresher and close the connections to the server."""
+        with self._refresh_timer_lock:
+            timers = set(self._running_refreshes)
+            if self._refresh_timer is not None:
+                timers.add(self._refresh_timer)
+        self.stop_background_refresher()
+        # wait for running refreshes, they would otherwise open a new session after this one was closed
+        for timer in timers - {current_thread()}:
+            timer.join()
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def __enter__(self) -> 'ConnectedDriveAccount':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
     def _log_response_to_file(self, response: requests.Response, logfilename: str = None) -> None:
         """If a log path is set, log all resonses to a file."""
         if self._log_responses is None or logfilename is None:
             return
 
-        anonymized_data = json.dumps(self._anonymize_data(response.json()), indent=2, sort_keys=True)
+        anonymized_data = self._anonymize_data(response.json())
 
         output_path = None
-        count = 0
+        count = self._log_file_counters.get(logfilename, 0)
 
         while output_path is None or output_path.exists():
             output_path = self._log_responses / '{}_{}.txt'.format(logfilename, count)
             count += 1
+        self._log_file_counters[logfilename] = count
 
         with open(output_path, 'w') as logfile:
-            logfile.write(anonymized_data)
+            json.dump(anonymized_data, logfile, indent=2, sort_keys=True)
 
     @staticmethod
     def _anonymize_data(json_data: dict) -> dict:
@@ -212,12 +428,17 @@ class ConnectedDriveAccount:  # pylint: disable=too-many-instance-attributes
             self._server_url = get_server_url(self._region)
         return self._server_url
 
+    @property
+    def oauth_url(self) -> str:
+        """Get the url of the oauth token endpoint for this country."""
+        if self._oauth_url is None:
+            self._oauth_url = AUTH_URL.format(gcdm_oauth_endpoint=get_gcdm_oauth_endpoint(self._region))
+        return self._oauth_url
+
     def _get_vehicles(self):
         """Retrieve list of vehicle for the account."""
         _LOGGER.debug('Getting vehicle list')
-        self._get_oauth_token()
-        response = self.send_request(VEHICLES_URL.format(server=self.server_url), headers=self.request_header,
-                                     logfilename='vehicles')
+        response = self.send_request(VEHICLES_URL.format(server=self.server_url), logfilename='vehicles')
 
         for vehicle_dict in response.json()['vehicles']:
             self._vehicles.append(ConnectedDriveVehicle(self, vehicle_dict))
@@ -241,7 +241,8 @@ class RemoteServices:
         except ValueError:
             _LOGGER.error('Error decoding json response from the server.')
             _LOGGER.debug(response.headers)
-            _LOGGER.debug(response.text)
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug(response.text)
             raise
 
     def _trigger_state_update(self) -> None:
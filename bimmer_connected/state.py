@@ -80,6 +80,8 @@ class VehicleState:
             SERVICE_EFFICIENCY: '',
             SERVICE_NAVIGATION: ''}
 
+        self._service_urls = {}
+
         for service in self._url:
             self._attributes[service] = {}
 
@@ -96,9 +98,8 @@ class VehicleState:
 
         for service in self._vehicle.available_state_services:
             try:
-                response = self._account.send_request(
-                    self._url[service].format(server=self._account.server_url, vin=self._vehicle.vin),
-                    logfilename=service, params=params)
+                response = self._account.send_request(self._get_service_url(service),
+                                                      logfilename=service, params=params)
                 if not self._key[service]:
                     self._attributes[service] = response.json()
                 else:
@@ -111,6 +112,13 @@ class VehicleState:
         _LOGGER.debug(self._attributes)
         _LOGGER.debug('received new data from connected drive')
 
+    def _get_service_url(self, service: str) -> str:
+        """Get the url of a service for this vehicle."""
+        if service not in self._service_urls:
+            self._service_urls[service] = self._url[service].format(server=self._account.server_url,
+                                                                    vin=self._vehicle.vin)
+        return self._service_urls[service]
+
     @property
     @backend_parameter
     def attributes(self) -> dict:
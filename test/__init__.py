@@ -165,6 +165,13 @@ class BackendMock:
                                              params=params))
         return self._find_response(url)
 
+    def Session(self) -> 'BackendMock':  # pylint: disable=invalid-name
+        """Mock for requests.Session, the mock backend is used as session."""
+        return self
+
+    def close(self) -> None:
+        """Mock for requests.Session.close function."""
+
     def add_response(self, regex: str, data: str = None, data_files: List[str] = None,
                      headers: dict = None, status_code=200) -> None:
         """Add a response to the backend."""
@@ -1,29 +1,234 @@
 """Tests for ConnectedDriveAccount."""
 import json
+import pathlib
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
-from test import BackendMock, G31_VIN, TEST_USERNAME, TEST_PASSWORD, TEST_REGION
-from bimmer_connected.account import ConnectedDriveAccount
+from test import BackendMock, MockResponse, G31_VIN, TEST_USERNAME, TEST_PASSWORD, TEST_REGION
+from bimmer_connected.account import ConnectedDriveAccount, _get_retry_delay, _SHARED_TOKENS
 from bimmer_connected.country_selector import Regions
 
 
-class TestAccount(unittest.TestCase):
+class TestAccount(unittest.TestCase):  # pylint: disable=too-many-public-methods
     """Tests for ConnectedDriveAccount."""
 
     # pylint: disable=protected-access
 
+    def setUp(self):
+        """Do not reuse oauth tokens of accounts from other tests."""
+        _SHARED_TOKENS.clear()
+
     def test_token_vehicles(self):
         """Test getting backend token and vehicle list."""
         backend_mock = BackendMock()
         with mock.patch('bimmer_connected.account.requests', new=backend_mock):
             account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
-            self.assertIsNotNone(account._oauth_token)
+            self.assertIsNotNone(account._token.access_token)
             self.assertEqual(9, len(account.vehicles))
             vehicle = account.get_vehicle(G31_VIN)
             self.assertEqual(G31_VIN, vehicle.vin)
 
             self.assertIsNone(account.get_vehicle('invalid_vin'))
 
+    def test_token_refresh_margin(self):
+        """Test that the token is refreshed shortly before it expires."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            token_requests = len(backend_mock.last_request)
+
+            account._get_oauth_token()
+            self.assertEqual(token_requests, len(backend_mock.last_request))
+
+            account._token.refresh_at = time.time() - 1
+            account._get_oauth_token()
+            self.assertEqual(token_requests + 1, len(backend_mock.last_request))
+            # the token is valid for 28799 seconds and refreshed 5 minutes earlier
+            self.assertAlmostEqual(account._token.expiration - 300, account._token.refresh_at)
+
+    def test_token_refresh_margin_short_lived(self):
+        """Test that short lived tokens are not refreshed on every request."""
+        backend_mock = BackendMock()
+        backend_mock.responses[0] = MockResponse('https://.+/gcdm/.*/?oauth/token',
+                                                 data='{"access_token": "short_lived", "expires_in": 120}')
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            self.assertAlmostEqual(account._token.expiration - 60, account._token.refresh_at)
+            token_requests = len(backend_mock.last_request)
+            account._get_oauth_token()
+            self.assertEqual(token_requests, len(backend_mock.last_request))
+
+    def test_request_header(self):
+        """Test that the request header follows the oauth token and cannot be modified by callers."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            header = account.request_header
+            self.assertEqual('Bearer some_token_string', header['Authorization'])
+            header['accept'] = 'image/png'
+            self.assertEqual('application/json', account.request_header['accept'])
+
+            account._token.access_token = 'new_token'
+            self.assertEqual('Bearer new_token', account.request_header['Authorization'])
+
+    def test_valid_token_without_lock(self):
+        """Test that the lock is not used while the token is valid."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            account._token.lock = mock.MagicMock()
+            account._get_oauth_token()
+            account._token.lock.__enter__.assert_not_called()
+
+    def test_token_per_user(self):
+        """Test that accounts with the same credentials share the oauth token."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            same_user = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            other_password = ConnectedDriveAccount(TEST_USERNAME, 'other_password', Regions.REST_OF_WORLD)
+            other_user = ConnectedDriveAccount('other_user', TEST_PASSWORD, Regions.REST_OF_WORLD)
+            other_region = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.NORTH_AMERICA)
+
+            self.assertIs(account._token, same_user._token)
+            self.assertIsNot(account._token, other_password._token)
+            self.assertIsNot(account._token, other_user._token)
+            self.assertIsNot(account._token, other_region._token)
+
+    def test_shared_token_requested_once(self):
+        """Test that accounts with the same credentials only request one token."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            same_user = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            token_requests = [r for r in backend_mock.last_request if 'oauth' in r.url]
+            self.assertEqual(1, len(token_requests))
+
+            account._token.refresh_at = time.time() - 1
+            self.assertEqual(account.request_header, same_user.request_header)
+            token_requests = [r for r in backend_mock.last_request if 'oauth' in r.url]
+            self.assertEqual(2, len(token_requests))
+
+    def test_background_refresher(self):
+        """Test scheduling the background token refresh."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            with mock.patch('bimmer_connected.account.Timer') as mocked_timer:
+                account.start_background_refresher()
+                delay = mocked_timer.call_args[0][0]
+                # the token is valid for 28799 seconds and refreshed 5 minutes earlier
+                self.assertAlmostEqual(28799 - 300, delay, delta=5)
+                mocked_timer.return_value.start.assert_called_once_with()
+
+                account.stop_background_refresher()
+                mocked_timer.return_value.cancel.assert_called_once_with()
+
+    def test_background_refresher_error(self):
+        """Test that the background refresh is retried after any error."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            with mock.patch('bimmer_connected.account.Timer') as mocked_timer:
+                account.start_background_refresher()
+                # run the callback as if it was called by the timer
+                with mock.patch.object(account, '_get_oauth_token', side_effect=ValueError), \
+                        mock.patch('bimmer_connected.account.current_thread', return_value=mocked_timer.return_value):
+                    account._refresh_token_in_background()
+                self.assertEqual(60, mocked_timer.call_args[0][0])
+
+                # a timer that is not running anymore is replaced
+                mocked_timer.return_value.is_alive.return_value = False
+                account.start_background_refresher()
+                self.assertEqual(3, mocked_timer.call_count)
+
+    def test_session_reuse(self):
+        """Test that all requests use the same session until the account is closed."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            with ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD) as account:
+                session = account._session
+                self.assertIs(backend_mock, session)
+                account.update_vehicle_states()
+                self.assertIs(session, account._session)
+            self.assertIsNone(account._session)
+
+    def test_restart_during_background_refresh(self):
+        """Test that a refresh running while the refresher is restarted does not schedule another timer."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            refresh_started = threading.Event()
+            refresh_continue = threading.Event()
+
+            def _slow_refresh():
+                refresh_started.set()
+                refresh_continue.wait(1)
+
+            with mock.patch.object(account, '_get_oauth_token', side_effect=_slow_refresh):
+                account._schedule_token_refresh(0)
+                first_timer = account._refresh_timer
+                self.assertTrue(refresh_started.wait(1))
+                account.stop_background_refresher()
+                account.start_background_refresher()
+                second_timer = account._refresh_timer
+                refresh_continue.set()
+                first_timer.join()
+
+            self.assertIs(second_timer, account._refresh_timer)
+            account.stop_background_refresher()
+            second_timer.join(1)
+            self.assertFalse(second_timer.is_alive())
+
+    def test_close_waits_for_background_refresh(self):
+        """Test that closing the account waits for a running background refresh."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            refresh_started = threading.Event()
+
+            def _slow_refresh():
+                refresh_started.set()
+                time.sleep(0.1)
+                account._get_session()
+
+            with mock.patch.object(account, '_get_oauth_token', side_effect=_slow_refresh):
+                account._schedule_token_refresh(0)
+                timer = account._refresh_timer
+                self.assertTrue(refresh_started.wait(1))
+                account.close()
+            self.assertFalse(timer.is_alive())
+            self.assertIsNone(account._refresh_timer)
+            self.assertIsNone(account._session)
+
+    def test_close_after_restart_during_background_refresh(self):
+        """Test that no session is left open when closing after restarting the refresher during a refresh."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            refresh_started = threading.Event()
+
+            def _slow_refresh():
+                refresh_started.set()
+                time.sleep(0.1)
+                account._get_session()
+
+            with mock.patch.object(account, '_get_oauth_token', side_effect=_slow_refresh):
+                account._schedule_token_refresh(0)
+                first_timer = account._refresh_timer
+                self.assertTrue(refresh_started.wait(1))
+                account.stop_background_refresher()
+                account.start_background_refresher()
+                second_timer = account._refresh_timer
+                account.close()
+
+            self.assertFalse(first_timer.is_alive())
+            self.assertFalse(second_timer.is_alive())
+            self.assertIsNone(account._refresh_timer)
+            self.assertIsNone(account._session)
+
     def test_invalid_send_response(self):
         """Test parsing the results of an invalid request"""
         backend_mock = BackendMock()
@@ -32,6 +237,87 @@ class TestAccount(unittest.TestCase):
             with self.assertRaises(IOError):
                 account.send_request('invalid_url')
 
+    def test_retry_on_too_many_requests(self):
+        """Test that requests rejected with error 429 are retried."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            backend_mock.add_response('https://.+/rate_limited$', data='{}', status_code=429,
+                                      headers={'Retry-After': '2'})
+            with mock.patch('bimmer_connected.account.time.sleep') as mocked_sleep:
+                with self.assertRaises(IOError):
+                    account.send_request('https://example.com/rate_limited')
+            self.assertEqual([mock.call(2)] * 3, mocked_sleep.call_args_list)
+
+    def test_no_retry_on_long_retry_after(self):
+        """Test that rate limited requests are not retried before the server allows it."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            backend_mock.add_response('https://.+/rate_limited$', data='{}', status_code=429,
+                                      headers={'Retry-After': '120'})
+            request_count = len(backend_mock.last_request)
+            with mock.patch('bimmer_connected.account.time.sleep') as mocked_sleep:
+                with self.assertRaises(IOError):
+                    account.send_request('https://example.com/rate_limited')
+            mocked_sleep.assert_not_called()
+            self.assertEqual(request_count + 1, len(backend_mock.last_request))
+
+    def test_no_backoff_on_token_request(self):
+        """Test that a rate limited token request does not wait while holding the token lock."""
+        backend_mock = BackendMock()
+        backend_mock.responses[0] = MockResponse('https://.+/gcdm/.*/?oauth/token', data='{}', status_code=429)
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            with mock.patch('bimmer_connected.account.time.sleep') as mocked_sleep:
+                with self.assertRaises(OSError):
+                    ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+            mocked_sleep.assert_not_called()
+
+    def test_retry_on_server_error(self):
+        """Test that requests failing with error 500 are retried."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD,
+                                            retries_on_500_error=2)
+            backend_mock.add_response('https://.+/server_error$', data='{}', status_code=500)
+            request_count = len(backend_mock.last_request)
+            response = account.send_request('https://example.com/server_error')
+            self.assertEqual(500, response.status_code)
+            self.assertEqual(request_count + 3, len(backend_mock.last_request))
+
+    def test_retries_shared_between_errors(self):
+        """Test that alternating errors 500 and 429 do not restart the retries for each other."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD,
+                                            retries_on_500_error=2, retries_on_429_error=2)
+            server_error = MockResponse('', data='{}', status_code=500)
+            rate_limited = MockResponse('', data='{}', status_code=429, headers={'Retry-After': '1'})
+            with mock.patch.object(backend_mock, 'get', side_effect=[rate_limited, server_error] * 10) as mocked_get, \
+                    mock.patch('bimmer_connected.account.time.sleep') as mocked_sleep:
+                with self.assertRaises(IOError):
+                    account.send_request('https://example.com/flaky')
+            # 2 retries for each error and the final response
+            self.assertEqual(5, mocked_get.call_count)
+            self.assertEqual(2, mocked_sleep.call_count)
+
+    def test_retry_delay(self):
+        """Test calculating the time to wait before retrying a request."""
+        response = mock.MagicMock(headers={'Retry-After': '120'})
+        self.assertEqual(120, _get_retry_delay(0, response))
+
+        response = mock.MagicMock(headers={'Retry-After': ' 15 '})
+        self.assertEqual(15, _get_retry_delay(0, response))
+
+        response = mock.MagicMock(headers={'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(0, _get_retry_delay(0, response))
+
+        response = mock.MagicMock(headers={})
+        for attempt in range(10):
+            delay = _get_retry_delay(attempt, response)
+            self.assertGreaterEqual(delay, min(30, 2 ** attempt))
+            self.assertLessEqual(delay, min(30, 2 ** attempt * 1.5))
+
     def test_invalid_auth(self):
         """Test if the host is set correctly in the request."""
         backend_mock = BackendMock()
@@ -41,6 +327,19 @@ class TestAccount(unittest.TestCase):
                 with self.assertRaises(OSError):
                     ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
 
+    def test_invalid_auth_logging(self):
+        """Test that the response of a failed login is logged for debugging."""
+        backend_mock = BackendMock()
+        backend_mock.responses[0] = MockResponse('https://.+/gcdm/.*/?oauth/token', data='invalid credentials',
+                                                 status_code=401)
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock):
+            with self.assertLogs('bimmer_connected.account', level='DEBUG') as logs:
+                with self.assertRaises(OSError):
+                    ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD)
+        log_output = '\n'.join(logs.output)
+        self.assertIn('UNAUTHORIZED', log_output)
+        self.assertIn('invalid credentials', log_output)
+
     def test_china_header(self):
         """Test if the host is set correctly in the request."""
         backend_mock = BackendMock()
@@ -49,6 +348,20 @@ class TestAccount(unittest.TestCase):
             request = [r for r in backend_mock.last_request if 'oauth' in r.url][0]
             self.assertEqual('customer.bmwgroup.cn', request.headers['Host'])
 
+    def test_log_responses(self):
+        """Test that logged responses do not overwrite each other."""
+        backend_mock = BackendMock()
+        with mock.patch('bimmer_connected.account.requests', new=backend_mock), \
+                tempfile.TemporaryDirectory() as log_dir:
+            log_path = pathlib.Path(log_dir)
+            (log_path / 'vehicles_0.txt').touch()
+            account = ConnectedDriveAccount(TEST_USERNAME, TEST_PASSWORD, Regions.REST_OF_WORLD,
+                                            log_responses=log_path)
+            account._get_vehicles()
+            account._get_vehicles()
+            self.assertEqual(['vehicles_0.txt', 'vehicles_1.txt', 'vehicles_2.txt', 'vehicles_3.txt'],
+                             sorted(path.name for path in log_path.iterdir()))
+
     def test_anonymize_data(self):
         """Test anonymization function."""
         test_dict = {